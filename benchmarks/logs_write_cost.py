@@ -0,0 +1,148 @@
+"""Стоимость записи в logs: старая схема (действие строкой, rollback-журнал)
+против текущего пути main._insert_log (коды действий, справочник причин,
+агрегаты статистики, WAL).
+
+Запуск из корня репозитория:
+    python benchmarks/logs_write_cost.py            # 200k строк, один commit
+    N=5000 COMMIT_EACH=1 python benchmarks/logs_write_cost.py
+
+Первый режим меряет процессорную стоимость вставки и размер таблиц,
+второй — то, что реально платит log_action: commit на каждое действие.
+Строка «только logs» отключает update_stats, чтобы отделить схему логов
+от агрегатов /stats.
+"""
+import importlib
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+N = int(os.environ.get("N", 200_000))
+COMMIT_EACH = os.environ.get("COMMIT_EACH") == "1"
+
+REASONS = [f"спам рекламой канала номер {i}" for i in range(50)]
+
+
+def sample_rows(main):
+    # (старый текст действия, код, duration, reason, new_role) в пропорциях
+    # живого лога: муты/размуты преобладают, у киков повторяющиеся причины;
+    # нарушители, модераторы и чаты повторяются, как в реальных группах
+    random.seed(1)
+    targets = [random.randrange(10**9, 7 * 10**9) for _ in range(5000)]
+    moderators = [random.randrange(10**8, 10**9) for _ in range(50)]
+    chats = [-1001234567890 - i for i in range(30)]
+    rows = []
+    for i in range(N):
+        r = random.random()
+        if r < .35:
+            action = ("замьютил до 2025-01-01 12:00 UTC", main.ACTION_MUTE, 600, None, None)
+        elif r < .55:
+            action = ("размутил", main.ACTION_UNMUTE, None, None, None)
+        elif r < .75:
+            reason = random.choice(REASONS)
+            action = (f"кик по причине {reason}", main.ACTION_KICK, None, reason, None)
+        elif r < .85:
+            action = ("clear (бан + удаление сообщений)", main.ACTION_CLEAR, None, None, None)
+        elif r < .95:
+            action = ("delete (удаление сообщения)", main.ACTION_DELETE, None, None, None)
+        else:
+            action = ("повышение до 1", main.ACTION_PROMOTE, None, None, 1)
+        rows.append((random.choice(targets), 1_735_000_000 + i * 10,
+                     random.choice(moderators), random.choice(chats), action))
+    return rows
+
+
+def table_size(conn, *tables) -> int:
+    marks = ", ".join("?" * len(tables))
+    return conn.execute(f"SELECT SUM(pgsize) FROM dbstat WHERE name IN ({marks})", tables).fetchone()[0]
+
+
+def bench_old(workdir: str, rows) -> tuple:
+    conn = sqlite3.connect(os.path.join(workdir, "old.db"))
+    conn.execute("""
+        CREATE TABLE logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            target_id INTEGER NOT NULL,
+            time_ts INTEGER NOT NULL,
+            action TEXT NOT NULL,
+            by_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL
+        )
+    """)
+    start = time.perf_counter()
+    for target_id, time_ts, by_id, chat_id, action in rows:
+        conn.execute(
+            "INSERT INTO logs (target_id, time_ts, action, by_id, chat_id) VALUES (?, ?, ?, ?, ?)",
+            (target_id, time_ts, action[0], by_id, chat_id)
+        )
+        if COMMIT_EACH:
+            conn.commit()
+    conn.commit()
+    elapsed = time.perf_counter() - start
+    conn.execute("VACUUM")
+    size = table_size(conn, "logs")
+    conn.close()
+    return elapsed, size, 0
+
+
+def bench_new(main, workdir: str, name: str, rows, with_stats: bool) -> tuple:
+    # Свежая база на каждый прогон; пишет настоящий main._insert_log
+    main.DB_PATH = os.path.join(workdir, name)
+    main.conn = main.init_db()
+    main._reason_ids.clear()
+    update_stats = main.update_stats
+    if not with_stats:
+        main.update_stats = lambda *args: None
+    start = time.perf_counter()
+    for target_id, time_ts, by_id, chat_id, action in rows:
+        main._insert_log(target_id, time_ts, action[1], by_id, chat_id, action[2], action[3], action[4])
+        if COMMIT_EACH:
+            main.conn.commit()
+    main.conn.commit()
+    elapsed = time.perf_counter() - start
+    main.update_stats = update_stats
+    main.conn.execute("VACUUM")
+    size = table_size(main.conn, "logs", "reasons")
+    stats_size = table_size(main.conn, "stats_chat_daily", "stats_moderator_daily", "stats_target")
+    main.conn.close()
+    return elapsed, size, stats_size
+
+
+def load_main(workdir: str):
+    # main.py всё делает при импорте: база, конфиг и сессия — относительно cwd
+    os.makedirs(os.path.join(workdir, "resources"))
+    with open(os.path.join(workdir, "resources", "config.json"), "w", encoding="utf-8") as f:
+        json.dump({"log_chat_id": 0}, f)
+    os.chdir(workdir)
+    os.environ.setdefault("API_ID", "1")
+    os.environ.setdefault("API_HASH", "hash")
+    os.environ.setdefault("BOT_TOKEN", "1:token")
+    sys.path.insert(0, REPO_ROOT)
+    return importlib.import_module("main")
+
+
+def main():
+    workdir = tempfile.mkdtemp()
+    bot = load_main(workdir)
+    bot.conn.close()
+    rows = sample_rows(bot)
+    results = [
+        ("старая схема", bench_old(workdir, rows)),
+        ("новая, только logs", bench_new(bot, workdir, "logs_only.db", rows, with_stats=False)),
+        ("новая, весь log_action", bench_new(bot, workdir, "full.db", rows, with_stats=True)),
+    ]
+    mode = "commit на каждую строку" if COMMIT_EACH else "один commit"
+    print(f"строк: {N}, {mode}")
+    for title, (elapsed, size, stats_size) in results:
+        line = f"{title:<24} {elapsed / N * 1e6:8.2f} мкс/строка, logs+reasons {size / 2**20:6.2f} MiB"
+        if stats_size:
+            line += f", агрегаты {stats_size / 2**20:.2f} MiB"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
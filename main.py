@@ -1,22 +1,53 @@
 import asyncio
+import functools
+import gzip
+import io
+import json
 import os
+import re
+import sys
+import threading
 import time
+import atexit
 import logging
+import logging.handlers
+import queue
+from collections import Counter, OrderedDict, deque, namedtuple
 import sqlite3
 from datetime import datetime, timezone
 from dotenv import load_dotenv
 from pyrogram import Client, filters, idle
 from pyrogram.types import ChatPermissions
 from pyrogram.enums import ParseMode
-from pyrogram.errors import RPCError
+from pyrogram.errors import BadRequest, FloodWait, Forbidden, RPCError
 
 # --------- ПУТЬ К РЕСУРСАМ ---------
 RESOURCES_DIR = "resources"
 os.makedirs(RESOURCES_DIR, exist_ok=True)
 DB_PATH = os.path.join(RESOURCES_DIR, "bot.db")
+LOG_PATH = os.path.join(RESOURCES_DIR, "bot.log")
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUP_COUNT = 3
 
 # ------------- НАСТРОЙКА ЛОГИРОВАНИЯ -------------
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Хендлеры бота только кладут записи в очередь, в консоль и файл их пишет
+# отдельный поток QueueListener
+log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(log_formatter)
+file_handler = logging.handlers.RotatingFileHandler(
+    LOG_PATH, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+)
+file_handler.setFormatter(log_formatter)
+log_queue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(log_queue, console_handler, file_handler)
+# QueueHandler.prepare() уже форматирует запись — оставляем только текст,
+# время и уровень добавит log_formatter в слушателе
+queue_handler = logging.handlers.QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+log_listener.start()
+atexit.register(log_listener.stop)
 logging.info("Бот запускается...")
 
 # ------------- ЗАГРУЖАЕМ СЕКРЕТЫ -------------
@@ -40,10 +71,23 @@ with open(config_path, "r", encoding="utf-8") as f:
 DEFAULT_MUTE_SECONDS = config.get("default_mute_seconds", 600)
 LOG_CHAT_ID = config.get("log_chat_id", 0)
 FILE_ID = config.get("file_id", None)
+WORKERS = config.get("workers", 32)
+LOOP_LAG_THRESHOLD = config.get("loop_lag_threshold", 0.5)
+OPERATOR_ID = config.get("operator_id", 0)
+OUTBOX_WORKERS = config.get("outbox_workers", 4)
+REPORT_WINDOW = config.get("report_window", 600)
+USER_CACHE_TTL = config.get("user_cache_ttl", 86400)
+LOG_BATCH_SIZE = config.get("log_batch_size", 20)
+LOG_BATCH_SECONDS = config.get("log_batch_seconds", 10)
+REPORT_MAX_PENDING = config.get("report_max_pending", 1000)
+OUTBOX_MAX_ATTEMPTS = config.get("outbox_max_attempts", 10)
 
 # ------------- ИНИЦИАЛИЗАЦИЯ БАЗЫ ДАННЫХ -------------
 def init_db():
     conn = sqlite3.connect(DB_PATH)
+    # Каждое действие — отдельный commit: в WAL он стоит одну запись в журнал
+    # вместо копии страниц в rollback-журнал и нескольких fsync
+    conn.execute("PRAGMA journal_mode=WAL")
     cursor = conn.cursor()
     # Таблица админов
     cursor.execute("""
@@ -63,17 +107,136 @@ def init_db():
             PRIMARY KEY (chat_id, user_id)
         )
     """)
-    # Таблица логов
+    # Старая схема логов хранила действие строкой — переименовываем её,
+    # строки переносятся в новую таблицу фоном (см. backfill_legacy_logs)
+    columns = {row[1]: row[2] for row in cursor.execute("PRAGMA table_info(logs)")}
+    if columns.get("action") == "TEXT":
+        cursor.execute("ALTER TABLE logs RENAME TO logs_legacy")
+    # Справочник причин (одна строка на уникальный текст)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS reasons (
+            id INTEGER PRIMARY KEY,
+            text TEXT NOT NULL UNIQUE
+        )
+    """)
+    # Таблица логов: код действия + типизированные аргументы
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id INTEGER PRIMARY KEY,
             target_id INTEGER NOT NULL,
             time_ts INTEGER NOT NULL,
-            action TEXT NOT NULL,
+            action INTEGER NOT NULL,
+            by_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            duration INTEGER,
+            reason_id INTEGER REFERENCES reasons(id),
+            new_role INTEGER
+        )
+    """)
+    # Агрегаты статистики: обновляются вместе с записью в logs и
+    # переживают cleanup_logs
+    stats_seeded = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'stats_chat_daily'"
+    ).fetchone() is not None
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS stats_chat_daily (
+            chat_id INTEGER NOT NULL,
+            day INTEGER NOT NULL,
+            action INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, day, action)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS stats_moderator_daily (
+            chat_id INTEGER NOT NULL,
+            by_id INTEGER NOT NULL,
+            day INTEGER NOT NULL,
+            action INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, by_id, day, action)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS stats_target (
+            chat_id INTEGER NOT NULL,
+            target_id INTEGER NOT NULL,
+            action INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, target_id, action)
+        ) WITHOUT ROWID
+    """)
+    # Федерация: чаты с общим бан-листом, сам список и незавершённые рассылки банов
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS federation_chats (
+            chat_id INTEGER PRIMARY KEY
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS federated_bans (
+            user_id INTEGER PRIMARY KEY,
+            origin_chat_id INTEGER NOT NULL,
+            by_id INTEGER NOT NULL,
+            time_ts INTEGER NOT NULL
+        )
+    """)
+    # Где именно пользователь забанен из-за федерации: source = 'manual' для чата,
+    # где бан выдали вручную, 'fanout' — где его поставила рассылка или вход в чат.
+    # /unfedban снимает только баны 'fanout'
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS federated_ban_chats (
+            user_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            source TEXT NOT NULL,
+            PRIMARY KEY (user_id, chat_id)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS fanout_jobs (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            origin_chat_id INTEGER NOT NULL,
             by_id INTEGER NOT NULL,
-            chat_id INTEGER NOT NULL
+            cursor INTEGER NOT NULL,
+            queued INTEGER NOT NULL DEFAULT 0,
+            skipped INTEGER NOT NULL DEFAULT 0
         )
     """)
+    # Outbox: побочные действия модерации, которые надо выполнить в Telegram
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY,
+            idempotency_key TEXT NOT NULL UNIQUE,
+            kind TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            arg INTEGER,
+            run_at REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS outbox_run_at ON outbox (run_at)")
+    # Муты, записанные до появления outbox, получают свою задачу на размут
+    cursor.execute("""
+        INSERT OR IGNORE INTO outbox (idempotency_key, kind, chat_id, user_id, arg, run_at)
+        SELECT 'unmute:' || chat_id || ':' || user_id || ':' || unmute_ts, 'unmute',
+               chat_id, user_id, unmute_ts, unmute_ts
+        FROM mutes
+    """)
+    if not stats_seeded:
+        # Первый запуск со статистикой — считаем то, что уже есть в logs
+        cursor.execute("""
+            INSERT INTO stats_chat_daily (chat_id, day, action, count)
+            SELECT chat_id, time_ts / 86400, action, COUNT(*) FROM logs GROUP BY 1, 2, 3
+        """)
+        cursor.execute("""
+            INSERT INTO stats_moderator_daily (chat_id, by_id, day, action, count)
+            SELECT chat_id, by_id, time_ts / 86400, action, COUNT(*) FROM logs GROUP BY 1, 2, 3, 4
+        """)
+        cursor.execute("""
+            INSERT INTO stats_target (chat_id, target_id, action, count)
+            SELECT chat_id, target_id, action, COUNT(*) FROM logs GROUP BY 1, 2, 3
+        """)
     conn.commit()
     return conn
 
@@ -103,13 +266,122 @@ class RequestTracker:
 
 request_tracker = RequestTracker()
 
+# Акторы по чатам: у каждого чата своя очередь команд и одна задача, которая
+# их выполняет. Команды одного чата идут строго по очереди, разные чаты —
+# параллельно, а воркер диспетчера pyrogram освобождается сразу
+class ChatActors:
+    def __init__(self):
+        # структура: { key : deque фабрик корутин }
+        self.mailboxes = {}
+        # структура: { key : задача, разбирающая очередь }
+        self.consumers = {}
+
+    def submit(self, key, job):
+        mailbox = self.mailboxes.get(key)
+        if mailbox is None:
+            mailbox = self.mailboxes[key] = deque()
+            self.consumers[key] = asyncio.create_task(self._consume(key, mailbox))
+        mailbox.append(job)
+
+    async def call(self, key, job):
+        # выполнить job в очереди чата и дождаться результата
+        future = asyncio.get_running_loop().create_future()
+
+        async def wrapped():
+            try:
+                result = await job()
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+
+        self.submit(key, wrapped)
+        return await future
+
+    async def _consume(self, key, mailbox):
+        while mailbox:
+            job = mailbox.popleft()
+            try:
+                await job()
+            except Exception:
+                logging.exception(f"Ошибка при выполнении команды в чате {key}")
+        # очередь пуста — задача завершается, следующий submit создаст новую
+        del self.mailboxes[key]
+        del self.consumers[key]
+
+    async def drain(self):
+        while self.consumers:
+            await asyncio.gather(*self.consumers.values())
+
+chat_actors = ChatActors()
+
+def serialized_per_chat(handler):
+    @functools.wraps(handler)
+    async def wrapper(client, message):
+        chat_actors.submit(message.chat.id, lambda: handler(client, message))
+    return wrapper
+
+# Склейка репортов: повторные репорты на одну цель в пределах окна обновляют
+# уже отправленное сообщение, а каждого модератора пингуем не чаще раза в окно
+class ReportAggregator:
+    def __init__(self, window, max_pending):
+        self.window = window
+        self.max_pending = max_pending
+        # структура: { (chat_id, цель) : {message_id, created, count, header, content, ping_list} }
+        self.reports = OrderedDict()
+        # структура: { (chat_id, moderator_id) : время последнего пинга }
+        self.pings = OrderedDict()
+
+    def _evict(self, store, created_of, now):
+        # записи лежат в порядке создания — устаревшие и лишние всегда в начале
+        while store:
+            oldest = next(iter(store.values()))
+            if now - created_of(oldest) < self.window and len(store) <= self.max_pending:
+                break
+            store.popitem(last=False)
+
+    def get_report(self, chat_id, target, now):
+        self._evict(self.reports, lambda report: report["created"], now)
+        return self.reports.get((chat_id, target))
+
+    def add_report(self, chat_id, target, report, now):
+        report["created"] = now
+        self.reports.pop((chat_id, target), None)
+        self.reports[(chat_id, target)] = report
+        self._evict(self.reports, lambda report: report["created"], now)
+
+    def pingable(self, chat_id, moderator_ids, now):
+        # те, кого в этом окне ещё не пинговали
+        self._evict(self.pings, lambda pinged_at: pinged_at, now)
+        return [uid for uid in moderator_ids if (chat_id, uid) not in self.pings]
+
+    def mark_pinged(self, chat_id, moderator_ids, now):
+        # вызывается только после того, как пинг реально ушёл
+        for uid in moderator_ids:
+            self.pings[(chat_id, uid)] = now
+        self._evict(self.pings, lambda pinged_at: pinged_at, now)
+
+report_aggregator = ReportAggregator(REPORT_WINDOW, REPORT_MAX_PENDING)
+
+def format_report(report) -> str:
+    text = f"{report['header']}\n> {report['content']}"
+    if report["count"] > 1:
+        text += f"\nРепортов: {report['count']}"
+    return f"{text}\n{report['ping_line']}"
+
 # ------------- ФУНКЦИИ ДЛЯ РОЛЕЙ -------------
+# Индекс ролей в памяти: таблица admins маленькая и меняется только через
+# set_role/del_role, так что читаем её целиком один раз при старте
+def load_role_index():
+    cursor = conn.execute("SELECT chat_id, user_id, role FROM admins")
+    return {(chat_id, user_id): role for chat_id, user_id, role in cursor}
+
+role_index = load_role_index()
+
 def get_role(chat_id: int, user_id: int) -> int:
-    cursor = conn.execute(
-        "SELECT role FROM admins WHERE chat_id = ? AND user_id = ?", (chat_id, user_id)
-    )
-    row = cursor.fetchone()
-    return row[0] if row else 0
+    return role_index.get((chat_id, user_id), 0)
 
 # Преобразование роли в строку
 def role_to_str(role: int) -> str:
@@ -128,79 +400,473 @@ def set_role(chat_id: int, user_id: int, role: int):
         (chat_id, user_id, role)
     )
     conn.commit()
+    role_index[(chat_id, user_id)] = role
 
 def del_role(chat_id: int, user_id: int):
     conn.execute(
         "DELETE FROM admins WHERE chat_id = ? AND user_id = ?", (chat_id, user_id)
     )
     conn.commit()
+    role_index.pop((chat_id, user_id), None)
 
 # ------------- МУТЫ -------------
 def add_mute(chat_id: int, user_id: int, unmute_ts: int):
+    # мут и задача на размут пишутся одной транзакцией
     conn.execute(
         "INSERT OR REPLACE INTO mutes (chat_id, user_id, unmute_ts) VALUES (?, ?, ?)",
         (chat_id, user_id, unmute_ts)
     )
+    cancel_jobs("unmute", chat_id, user_id)
+    enqueue_job("unmute", chat_id, user_id, unmute_ts, f"unmute:{chat_id}:{user_id}:{unmute_ts}", arg=unmute_ts)
     conn.commit()
+    outbox.notify()
 
 def del_mute(chat_id: int, user_id: int):
     conn.execute(
         "DELETE FROM mutes WHERE chat_id = ? AND user_id = ?", (chat_id, user_id)
     )
+    cancel_jobs("unmute", chat_id, user_id)
     conn.commit()
 
-def get_all_mutes():
-    cursor = conn.execute("SELECT chat_id, user_id, unmute_ts FROM mutes")
+def get_mute(chat_id: int, user_id: int):
+    cursor = conn.execute(
+        "SELECT unmute_ts FROM mutes WHERE chat_id = ? AND user_id = ?", (chat_id, user_id)
+    )
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+# ------------- КОДЫ ДЕЙСТВИЙ -------------
+ACTION_UNKNOWN = 0
+ACTION_PROMOTE = 1
+ACTION_DEMOTE = 2
+ACTION_KICK = 3
+ACTION_MUTE = 4
+ACTION_UNMUTE = 5
+ACTION_CLEAR = 6
+ACTION_DELETE = 7
+ACTION_WHOREBOT = 8
+ACTION_FEDERATED_BAN = 9
+ACTION_FEDERATED_UNBAN = 10
+
+# Текст действия собирается только при выводе
+def render_action(time_ts: int, action: int, duration, reason, new_role) -> str:
+    if action == ACTION_PROMOTE:
+        return f"повышение до {new_role}"
+    if action == ACTION_DEMOTE:
+        return "понижение"
+    if action == ACTION_KICK:
+        return f"кик по причине {reason}" if reason else "кик без причины"
+    if action == ACTION_MUTE:
+        until_dt = datetime.fromtimestamp(time_ts + (duration or 0), timezone.utc)
+        return f"замьютил до {until_dt.strftime('%Y-%m-%d %H:%M UTC')}"
+    if action == ACTION_UNMUTE:
+        return "размутил"
+    if action == ACTION_CLEAR:
+        return "clear (бан + удаление сообщений)"
+    if action == ACTION_DELETE:
+        return "delete (удаление сообщения)"
+    if action == ACTION_WHOREBOT:
+        return "шлюхобот (бан и отправка отчёта)"
+    if action == ACTION_FEDERATED_BAN:
+        return "федеративный бан во всех чатах сети"
+    if action == ACTION_FEDERATED_UNBAN:
+        return "снятие федеративного бана"
+    # ACTION_UNKNOWN: исходный текст старой записи лежит в причине
+    return reason or "неизвестное действие"
+
+# Разбор строк из старой схемы: (action, duration, reason, new_role)
+_LEGACY_FIXED = {
+    "понижение": ACTION_DEMOTE,
+    "кик без причины": ACTION_KICK,
+    "размутил": ACTION_UNMUTE,
+    "clear (бан + удаление сообщений)": ACTION_CLEAR,
+    "delete (удаление сообщения)": ACTION_DELETE,
+    "шлюхобот (бан и отправка отчёта)": ACTION_WHOREBOT,
+}
+_LEGACY_PROMOTE_RE = re.compile(r"^повышение до (\d+)$")
+_LEGACY_KICK_RE = re.compile(r"^кик по причине (.*)$", re.DOTALL)
+_LEGACY_MUTE_RE = re.compile(r"^замьютил до (\d{4}-\d{2}-\d{2} \d{2}:\d{2}) UTC$")
+
+def parse_legacy_action(time_ts: int, text: str):
+    if text in _LEGACY_FIXED:
+        return _LEGACY_FIXED[text], None, None, None
+    m = _LEGACY_PROMOTE_RE.match(text)
+    if m:
+        return ACTION_PROMOTE, None, None, int(m.group(1))
+    m = _LEGACY_KICK_RE.match(text)
+    if m:
+        return ACTION_KICK, None, m.group(1), None
+    m = _LEGACY_MUTE_RE.match(text)
+    if m:
+        until_dt = datetime.strptime(m.group(1), "%Y-%m-%d %H:%M").replace(tzinfo=timezone.utc)
+        return ACTION_MUTE, int(until_dt.timestamp()) - time_ts, None, None
+    return ACTION_UNKNOWN, None, text, None
+
+# ------------- СТАТИСТИКА -------------
+# Санкции, которые показывает /stats (clear и шлюхобот — это баны)
+STATS_ACTIONS = {
+    ACTION_MUTE: "муты",
+    ACTION_KICK: "кики",
+    ACTION_CLEAR: "баны",
+    ACTION_WHOREBOT: "баны",
+    ACTION_DELETE: "удаления",
+}
+
+def update_stats(target_id: int, time_ts: int, action: int, by_id: int, chat_id: int):
+    # Вызывается внутри транзакции log_action, коммит делает вызывающий
+    day = time_ts // 86400
+    conn.execute(
+        "INSERT INTO stats_chat_daily (chat_id, day, action, count) VALUES (?, ?, ?, 1) "
+        "ON CONFLICT (chat_id, day, action) DO UPDATE SET count = count + 1",
+        (chat_id, day, action)
+    )
+    conn.execute(
+        "INSERT INTO stats_moderator_daily (chat_id, by_id, day, action, count) VALUES (?, ?, ?, ?, 1) "
+        "ON CONFLICT (chat_id, by_id, day, action) DO UPDATE SET count = count + 1",
+        (chat_id, by_id, day, action)
+    )
+    conn.execute(
+        "INSERT INTO stats_target (chat_id, target_id, action, count) VALUES (?, ?, ?, 1) "
+        "ON CONFLICT (chat_id, target_id, action) DO UPDATE SET count = count + 1",
+        (chat_id, target_id, action)
+    )
+
+def _group_stats(rows):
+    # rows: (action, count) -> {подпись: сумма}
+    totals = {}
+    for action, count in rows:
+        label = STATS_ACTIONS.get(action)
+        if label:
+            totals[label] = totals.get(label, 0) + count
+    return totals
+
+def get_chat_stats(chat_id: int, since_day: int):
+    rows = conn.execute(
+        "SELECT action, SUM(count) FROM stats_chat_daily WHERE chat_id = ? AND day >= ? GROUP BY action",
+        (chat_id, since_day)
+    ).fetchall()
+    return _group_stats(rows)
+
+def get_moderator_stats(chat_id: int, since_day: int):
+    rows = conn.execute(
+        "SELECT by_id, action, SUM(count) FROM stats_moderator_daily "
+        "WHERE chat_id = ? AND day >= ? GROUP BY by_id, action",
+        (chat_id, since_day)
+    ).fetchall()
+    per_moderator = {}
+    for by_id, action, count in rows:
+        per_moderator.setdefault(by_id, []).append((action, count))
+    return {by_id: _group_stats(actions) for by_id, actions in per_moderator.items()}
+
+def get_most_sanctioned(chat_id: int, limit: int = 5):
+    placeholders = ", ".join("?" for _ in STATS_ACTIONS)
+    cursor = conn.execute(
+        f"SELECT target_id, SUM(count) AS total FROM stats_target "
+        f"WHERE chat_id = ? AND action IN ({placeholders}) "
+        f"GROUP BY target_id ORDER BY total DESC LIMIT ?",
+        (chat_id, *STATS_ACTIONS, limit)
+    )
     return cursor.fetchall()
 
 # ------------- ЛОГИРОВАНИЕ -------------
-def log_action(target_id: int, action: str, by_id: int, chat_id: int):
-    now_ts = int(time.time())
+_reason_ids = {}
+
+def get_reason_id(reason: str) -> int:
+    reason_id = _reason_ids.get(reason)
+    if reason_id is None:
+        row = conn.execute("SELECT id FROM reasons WHERE text = ?", (reason,)).fetchone()
+        if row is None:
+            reason_id = conn.execute("INSERT INTO reasons (text) VALUES (?)", (reason,)).lastrowid
+        else:
+            reason_id = row[0]
+        _reason_ids[reason] = reason_id
+    return reason_id
+
+def _insert_log(target_id: int, time_ts: int, action: int, by_id: int, chat_id: int,
+                duration=None, reason=None, new_role=None):
+    reason_id = get_reason_id(reason) if reason else None
     conn.execute(
-        "INSERT INTO logs (target_id, time_ts, action, by_id, chat_id) VALUES (?, ?, ?, ?, ?)",
-        (target_id, now_ts, action, by_id, chat_id)
+        "INSERT INTO logs (target_id, time_ts, action, by_id, chat_id, duration, reason_id, new_role) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (target_id, time_ts, action, by_id, chat_id, duration, reason_id, new_role)
     )
+    update_stats(target_id, time_ts, action, by_id, chat_id)
+
+def log_action(target_id: int, action: int, by_id: int, chat_id: int,
+               duration=None, reason=None, new_role=None):
+    now_ts = int(time.time())
+    _insert_log(target_id, now_ts, action, by_id, chat_id, duration, reason, new_role)
     conn.commit()
-    logging.info(f"Записано действие для {target_id}: {action} от {by_id} в чате {chat_id}")
+    text = render_action(now_ts, action, duration, reason, new_role)
+    logging.info(f"Записано действие для {target_id}: {text} от {by_id} в чате {chat_id}")
+    publish_event((now_ts, target_id, by_id, chat_id, text))
+
+def has_legacy_logs() -> bool:
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'logs_legacy'").fetchone()
+    return row is not None
 
 def get_user_logs(target_id: int):
     cursor = conn.execute(
-        "SELECT time_ts, action FROM logs WHERE target_id = ? ORDER BY time_ts DESC", (target_id,)
+        "SELECT l.time_ts, l.action, l.duration, r.text, l.new_role FROM logs l "
+        "LEFT JOIN reasons r ON r.id = l.reason_id WHERE l.target_id = ?", (target_id,)
+    )
+    rows = cursor.fetchall()
+    # Пока перенос не закончен, часть записей ещё в старой таблице
+    if has_legacy_logs():
+        legacy = conn.execute(
+            "SELECT time_ts, action FROM logs_legacy WHERE target_id = ?", (target_id,)
+        ).fetchall()
+        rows += [(time_ts, *parse_legacy_action(time_ts, text)) for time_ts, text in legacy]
+    rows.sort(key=lambda row: row[0], reverse=True)
+    return rows
+
+# ------------- ПЕРЕНОС СТАРЫХ ЛОГОВ -------------
+async def backfill_legacy_logs(batch_size: int = 500):
+    if not has_legacy_logs():
+        return
+    logging.info("Переношу логи из старой схемы...")
+    moved = 0
+    while True:
+        rows = conn.execute(
+            "SELECT id, target_id, time_ts, action, by_id, chat_id FROM logs_legacy ORDER BY id LIMIT ?",
+            (batch_size,)
+        ).fetchall()
+        if not rows:
+            break
+        for _, target_id, time_ts, text, by_id, chat_id in rows:
+            action, duration, reason, new_role = parse_legacy_action(time_ts, text)
+            _insert_log(target_id, time_ts, action, by_id, chat_id, duration, reason, new_role)
+        conn.execute("DELETE FROM logs_legacy WHERE id <= ?", (rows[-1][0],))
+        conn.commit()
+        moved += len(rows)
+        # отдаём управление хендлерам между пачками
+        await asyncio.sleep(0)
+    # VACUUM здесь не делаем: он переписывает всю базу и держит её заблокированной,
+    # а освободившиеся страницы и так займут новые записи
+    conn.execute("DROP TABLE logs_legacy")
+    conn.commit()
+    logging.info(f"Перенос логов завершён: {moved} записей")
+
+# ------------- OUTBOX МОДЕРАЦИОННЫХ ДЕЙСТВИЙ -------------
+# Вызовы Telegram, которые нельзя потерять, сначала записываются в таблицу
+# outbox в той же транзакции, что и изменение состояния, а затем выполняются
+# воркерами с повторами. После рестарта работа продолжается из таблицы.
+def enqueue_job(kind: str, chat_id: int, user_id: int, run_at: float, key: str, arg=None):
+    # без коммита — он делается вместе с изменением состояния
+    conn.execute(
+        "INSERT OR IGNORE INTO outbox (idempotency_key, kind, chat_id, user_id, arg, run_at) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (key, kind, chat_id, user_id, arg, run_at)
+    )
+
+def cancel_jobs(kind: str, chat_id: int, user_id: int):
+    conn.execute(
+        "DELETE FROM outbox WHERE kind = ? AND chat_id = ? AND user_id = ?", (kind, chat_id, user_id)
     )
-    return cursor.fetchall()
 
-# ------------- ФОНОВАЯ ФУНКЦИЯ ДЛЯ РАЗМЮТА -------------
-async def schedule_unmute(app: Client, chat_id: int, user_id: int, unmute_ts: int):
-    now = int(time.time())
-    delay = unmute_ts - now
+def cancel_user_jobs(kind: str, user_id: int):
+    conn.execute("DELETE FROM outbox WHERE kind = ? AND user_id = ?", (kind, user_id))
+
+def finish_job(job_id: int):
+    conn.execute("DELETE FROM outbox WHERE id = ?", (job_id,))
+    conn.commit()
+
+def retry_job(job_id: int, run_at: float, attempts: int):
+    conn.execute("UPDATE outbox SET run_at = ?, attempts = ? WHERE id = ?", (run_at, attempts, job_id))
+    conn.commit()
+
+async def execute_unmute(client: Client, chat_id: int, user_id: int, unmute_ts: int):
     chat_link = f"[чат](tg://chat?id={chat_id})"
-    if delay > 0:
-        await asyncio.sleep(delay)
-    try:
-        await app.restrict_chat_member(chat_id, user_id, permissions=ChatPermissions(
+
+    async def unmute():
+        # Мут могли снять или продлить — тогда задача устарела
+        if get_mute(chat_id, user_id) != unmute_ts:
+            return False
+        await client.restrict_chat_member(chat_id, user_id, permissions=ChatPermissions(
             can_send_messages=True,
             can_send_media_messages=True,
             can_send_other_messages=True,
             can_add_web_page_previews=True
         ))
         logging.info(f"Размутил {user_id} в чате {chat_link}")
-    except RPCError as e:
-        logging.warning(f"Не удалось размутить {user_id} в чате {chat_link}: {e}")
-    del_mute(chat_id, user_id)
+        del_mute(chat_id, user_id)
+        return True
+
+    # в очереди чата, вместе с /mute и /unmute
+    if not await chat_actors.call(chat_id, unmute):
+        return
     try:
-        user = await app.get_users(user_id)
-        username = getattr(user, 'username', None)
-        if username:
-            await app.send_message(chat_id, f"@{username} размучен автоматически.")
-        else:
-            await app.send_message(chat_id, f"Пользователь [ID:{user_id}] размучен автоматически.")
+        user = await resolve_user(client, user_id)
+        await client.send_message(chat_id, f"[{user.first_name}](tg://user?id={user_id}) размучен автоматически.")
     except RPCError:
         pass
     try:
-        await app.send_message(user_id, f"Ты размучен(а) в {chat_link}.", parse_mode=ParseMode.MARKDOWN)
+        await client.send_message(user_id, f"Ты размучен(а) в {chat_link}.", parse_mode=ParseMode.MARKDOWN)
     except RPCError:
         pass
 
+def abandon_unmute(chat_id: int, user_id: int, unmute_ts: int):
+    # Telegram всё равно снимет ограничение по until_date, чистим только базу
+    if get_mute(chat_id, user_id) == unmute_ts:
+        del_mute(chat_id, user_id)
+
+async def execute_unban(client: Client, chat_id: int, user_id: int, arg):
+    # вторая половина кика: бан уже выполнен в хендлере
+    await client.unban_chat_member(chat_id, user_id)
+
+async def execute_fedban(client: Client, chat_id: int, user_id: int, arg):
+    # к моменту выполнения бан могли снять или выдать пользователю роль в этом чате
+    if not is_federally_banned(user_id) or get_role(chat_id, user_id) >= 1:
+        return
+    await client.ban_chat_member(chat_id, user_id)
+
+# kind -> (выполнение, действие при окончательной неудаче)
+OUTBOX_KINDS = {
+    "unmute": (execute_unmute, abandon_unmute),
+    "unban": (execute_unban, None),
+    "fedban": (execute_fedban, None),
+}
+
+class Outbox:
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.queue = asyncio.Queue()
+        self.in_flight = set()
+        self.wakeup = asyncio.Event()
+
+    def notify(self):
+        self.wakeup.set()
+
+    async def dispatch(self, client: Client):
+        for _ in range(self.workers):
+            asyncio.create_task(self.worker(client))
+        while True:
+            self.wakeup.clear()
+            now = time.time()
+            due = conn.execute(
+                "SELECT id, kind, chat_id, user_id, arg, attempts FROM outbox WHERE run_at <= ? ORDER BY run_at",
+                (now,)
+            ).fetchall()
+            for job in due:
+                if job[0] not in self.in_flight:
+                    self.in_flight.add(job[0])
+                    self.queue.put_nowait(job)
+            next_run_at = conn.execute("SELECT MIN(run_at) FROM outbox WHERE run_at > ?", (now,)).fetchone()[0]
+            timeout = next_run_at - now if next_run_at is not None else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def worker(self, client: Client):
+        while True:
+            job = await self.queue.get()
+            try:
+                await self.run_job(client, *job)
+            except Exception:
+                # сбой вне вызова Telegram (например, в самой базе) — воркер не должен
+                # умирать, задача останется в таблице и будет взята снова
+                logging.exception(f"Сбой outbox-воркера на задаче {job[0]}")
+                await asyncio.sleep(1)
+            finally:
+                self.in_flight.discard(job[0])
+                self.notify()
+
+    async def run_job(self, client: Client, job_id, kind, chat_id, user_id, arg, attempts):
+        execute, on_failure = OUTBOX_KINDS[kind]
+        try:
+            await execute(client, chat_id, user_id, arg)
+            finish_job(job_id)
+        except FloodWait as e:
+            # ожидание по FloodWait попыткой не считается
+            logging.warning(f"FloodWait {e.value} с для {kind} {user_id} в чате {chat_id}")
+            retry_job(job_id, time.time() + e.value, attempts)
+        except (BadRequest, Forbidden) as e:
+            # повтор не поможет (нет прав, пользователя нет в чате и т.п.)
+            logging.warning(f"Не удалось выполнить {kind} для {user_id} в чате {chat_id}: {e}")
+            self.abandon(job_id, on_failure, chat_id, user_id, arg)
+        except Exception as e:
+            # прочие ошибки RPC, сетевые OSError/TimeoutError, ошибки sqlite
+            attempts += 1
+            if attempts >= OUTBOX_MAX_ATTEMPTS:
+                logging.warning(f"Отказ от {kind} для {user_id} в чате {chat_id} после {attempts} попыток: {e}")
+                self.abandon(job_id, on_failure, chat_id, user_id, arg)
+            else:
+                delay = min(2 ** attempts, 3600)
+                logging.warning(f"Ошибка {kind} для {user_id} в чате {chat_id}, повтор через {delay} с: {e}")
+                retry_job(job_id, time.time() + delay, attempts)
+
+    def abandon(self, job_id, on_failure, chat_id, user_id, arg):
+        if on_failure:
+            on_failure(chat_id, user_id, arg)
+        finish_job(job_id)
+
+outbox = Outbox(OUTBOX_WORKERS)
+
+# ------------- ЛЕНТА СОБЫТИЙ В LOG_CHAT_ID -------------
+TELEGRAM_TEXT_LIMIT = 4096
+mod_events = asyncio.Queue(maxsize=10000)
+
+def publish_event(event):
+    # event: (time_ts, target_id, by_id, chat_id, текст действия)
+    if not LOG_CHAT_ID:
+        return
+    try:
+        mod_events.put_nowait(event)
+    except asyncio.QueueFull:
+        logging.warning("Очередь ленты событий переполнена, событие пропущено")
+
+def format_event(event) -> str:
+    time_ts, target_id, by_id, chat_id, text = event
+    t = datetime.fromtimestamp(time_ts, timezone.utc).strftime("%Y-%m-%d %H:%M UTC")
+    return f"{t} [чат {chat_id}] {by_id} → {target_id}: {text}"
+
+def split_digest(lines) -> list:
+    # склеиваем строки в сообщения, не превышающие лимит Telegram
+    messages, current = [], ""
+    for line in lines:
+        line = line[:TELEGRAM_TEXT_LIMIT]
+        if current and len(current) + 1 + len(line) > TELEGRAM_TEXT_LIMIT:
+            messages.append(current)
+            current = ""
+        current = f"{current}\n{line}" if current else line
+    if current:
+        messages.append(current)
+    return messages
+
+async def send_digest(client: Client, text: str):
+    while True:
+        try:
+            await client.send_message(LOG_CHAT_ID, text, parse_mode=ParseMode.DISABLED)
+            return
+        except FloodWait as e:
+            await asyncio.sleep(e.value)
+        except RPCError as e:
+            logging.warning(f"Не удалось отправить ленту событий в {LOG_CHAT_ID}: {e}")
+            return
+
+async def event_feed(client: Client):
+    # Дайджест уходит, когда набралось LOG_BATCH_SIZE событий или прошло
+    # LOG_BATCH_SECONDS с первого события в пачке
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await mod_events.get()]
+        deadline = loop.time() + LOG_BATCH_SECONDS
+        while len(batch) < LOG_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(mod_events.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        for text in split_digest(format_event(event) for event in batch):
+            try:
+                await send_digest(client, text)
+            except Exception:
+                # сеть и прочие не-RPC ошибки: теряем этот дайджест, но не всю ленту
+                logging.exception(f"Не удалось отправить ленту событий в {LOG_CHAT_ID}")
+
 # ------------- ФУНКЦИЯ ДЛЯ ОЧИСТКИ ЛОГОВ -------------
 async def cleanup_logs():
     while True:
@@ -208,12 +874,303 @@ async def cleanup_logs():
         cutoff = now - 48 * 3600
         # Удаляем записи старше 48 часов
         conn.execute("DELETE FROM logs WHERE time_ts <= ?", (cutoff,))
+        # и причины, на которые больше не ссылается ни одна запись
+        conn.execute(
+            "DELETE FROM reasons WHERE id NOT IN (SELECT reason_id FROM logs WHERE reason_id IS NOT NULL)"
+        )
         conn.commit()
+        _reason_ids.clear()
         await asyncio.sleep(3600)
 
+# ------------- ФЕДЕРАЦИЯ -------------
+# Курсор рассылки — chat_id последнего обработанного чата (id групп отрицательные)
+FANOUT_CURSOR_START = -(2 ** 63)
+FANOUT_BATCH_SIZE = 100
+
+def is_federated(chat_id: int) -> bool:
+    row = conn.execute("SELECT 1 FROM federation_chats WHERE chat_id = ?", (chat_id,)).fetchone()
+    return row is not None
+
+def set_federated(chat_id: int, enabled: bool):
+    if enabled:
+        conn.execute("INSERT OR IGNORE INTO federation_chats (chat_id) VALUES (?)", (chat_id,))
+    else:
+        conn.execute("DELETE FROM federation_chats WHERE chat_id = ?", (chat_id,))
+    conn.commit()
+
+def is_federally_banned(user_id: int) -> bool:
+    row = conn.execute("SELECT 1 FROM federated_bans WHERE user_id = ?", (user_id,)).fetchone()
+    return row is not None
+
+def queue_fanout_ban(chat_id: int, user_id: int, key: str, replace: bool = False) -> bool:
+    # Ставит fedban и запоминает чат одной транзакцией (коммит делает вызывающий).
+    # Чат, где уже есть запись (например, ручной бан), без replace не трогаем
+    verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+    cursor = conn.execute(
+        f"{verb} INTO federated_ban_chats (user_id, chat_id, source) VALUES (?, ?, 'fanout')",
+        (user_id, chat_id)
+    )
+    if not cursor.rowcount:
+        return False
+    enqueue_job("fedban", chat_id, user_id, time.time(), key)
+    return True
+
+def create_fanout_job(user_id: int, origin_chat_id: int, by_id: int) -> int:
+    # первая запись в бан-листе остаётся, повторный бан из другого чата её не переписывает
+    conn.execute(
+        "INSERT OR IGNORE INTO federated_bans (user_id, origin_chat_id, by_id, time_ts) VALUES (?, ?, ?, ?)",
+        (user_id, origin_chat_id, by_id, int(time.time()))
+    )
+    conn.execute(
+        "INSERT OR REPLACE INTO federated_ban_chats (user_id, chat_id, source) VALUES (?, ?, 'manual')",
+        (user_id, origin_chat_id)
+    )
+    cursor = conn.execute(
+        "INSERT INTO fanout_jobs (user_id, origin_chat_id, by_id, cursor) VALUES (?, ?, ?, ?)",
+        (user_id, origin_chat_id, by_id, FANOUT_CURSOR_START)
+    )
+    conn.commit()
+    return cursor.lastrowid
+
+def lift_federated_ban(user_id: int, by_id: int, chat_id: int):
+    # Убираем из бан-листа, останавливаем незаконченную рассылку и разбаниваем
+    # только там, где бан поставила сама федерация; ручные баны чатов остаются
+    fanout_chats = [row[0] for row in conn.execute(
+        "SELECT chat_id FROM federated_ban_chats WHERE user_id = ? AND source = 'fanout'", (user_id,)
+    )]
+    conn.execute("DELETE FROM federated_bans WHERE user_id = ?", (user_id,))
+    conn.execute("DELETE FROM federated_ban_chats WHERE user_id = ?", (user_id,))
+    conn.execute("DELETE FROM fanout_jobs WHERE user_id = ?", (user_id,))
+    cancel_user_jobs("fedban", user_id)
+    now = time.time()
+    for fed_chat_id in fanout_chats:
+        enqueue_job("unban", fed_chat_id, user_id, now, f"fedunban:{fed_chat_id}:{user_id}:{int(now)}")
+    # коммит — в log_action
+    log_action(user_id, ACTION_FEDERATED_UNBAN, by_id, chat_id)
+    outbox.notify()
+
+def get_pending_fanout_jobs():
+    return [row[0] for row in conn.execute("SELECT id FROM fanout_jobs ORDER BY id")]
+
+async def run_fanout(job_id: int):
+    job = conn.execute(
+        "SELECT user_id, origin_chat_id, by_id, cursor, queued, skipped FROM fanout_jobs WHERE id = ?",
+        (job_id,)
+    ).fetchone()
+    if job is None:
+        return
+    user_id, origin_chat_id, by_id, cursor, queued, skipped = job
+    # Баны по чатам ставятся в outbox пачками по FANOUT_BATCH_SIZE (выполняют
+    # их воркеры outbox с повторами и учётом FloodWait). Задачи пачки и курсор
+    # пишутся одной транзакцией, так что после рестарта рассылка продолжается
+    # с места остановки и ничего не ставится дважды
+    while True:
+        # /unfedban удаляет строку рассылки — тогда останавливаемся без записи в логи
+        if conn.execute("SELECT 1 FROM fanout_jobs WHERE id = ?", (job_id,)).fetchone() is None:
+            return
+        chats = [row[0] for row in conn.execute(
+            "SELECT chat_id FROM federation_chats WHERE chat_id > ? AND chat_id != ? ORDER BY chat_id LIMIT ?",
+            (cursor, origin_chat_id, FANOUT_BATCH_SIZE)
+        )]
+        if not chats:
+            break
+        for chat_id in chats:
+            # модераторов и выше в чужих чатах федеративный бан не трогает,
+            # как и чаты, где пользователь уже забанен (вручную или раньше)
+            if get_role(chat_id, user_id) >= 1 or not queue_fanout_ban(chat_id, user_id, f"fedban:{job_id}:{chat_id}"):
+                skipped += 1
+                continue
+            queued += 1
+        cursor = chats[-1]
+        conn.execute(
+            "UPDATE fanout_jobs SET cursor = ?, queued = ?, skipped = ? WHERE id = ?",
+            (cursor, queued, skipped, job_id)
+        )
+        conn.commit()
+        outbox.notify()
+        await asyncio.sleep(0)
+    conn.execute("DELETE FROM fanout_jobs WHERE id = ?", (job_id,))
+    # одна запись на всю рассылку, коммит — в log_action
+    log_action(user_id, ACTION_FEDERATED_BAN, by_id, origin_chat_id)
+    logging.info(f"Федеративный бан {user_id}: поставлено в очередь {queued} чатов, пропущено {skipped}")
+
+def start_federated_ban(chat_id: int, user_id: int, by_id: int):
+    if not is_federated(chat_id):
+        return
+    job_id = create_fanout_job(user_id, chat_id, by_id)
+    asyncio.create_task(run_fanout(job_id))
+
+# ------------- ДИАГНОСТИКА -------------
+PROBE_INTERVAL = 1.0
+PROFILE_MAX_SECONDS = 60
+
+def stack_of(frame) -> list:
+    # от корня к листу, в формате collapsed stacks
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+class LoopMonitor:
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        self.loop_thread_id = None
+        self.heartbeat = time.monotonic()
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    async def probe(self):
+        # Раз в секунду меряем, насколько позже положенного проснулся sleep
+        self.loop_thread_id = threading.get_ident()
+        threading.Thread(target=self.watchdog, name="loop-watchdog", daemon=True).start()
+        while True:
+            started = time.monotonic()
+            self.heartbeat = started
+            await asyncio.sleep(PROBE_INTERVAL)
+            self.last_lag = time.monotonic() - started - PROBE_INTERVAL
+            self.max_lag = max(self.max_lag, self.last_lag)
+            if self.last_lag > self.threshold:
+                logging.warning(f"Задержка цикла событий: {self.last_lag:.3f} с")
+
+    def watchdog(self):
+        # Отдельный поток: если probe давно не просыпался, цикл кем-то занят —
+        # снимаем стек потока цикла, чтобы увидеть, кто именно его держит
+        reported = None
+        while True:
+            time.sleep(self.threshold)
+            heartbeat = self.heartbeat
+            stalled = time.monotonic() - heartbeat - PROBE_INTERVAL
+            if stalled <= self.threshold or reported == heartbeat:
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is not None:
+                stack = "\n".join(stack_of(frame)[-8:])
+                logging.warning(f"Цикл событий заблокирован {stalled:.3f} с, сейчас выполняется:\n{stack}")
+            reported = heartbeat
+
+loop_monitor = LoopMonitor(LOOP_LAG_THRESHOLD)
+# одновременно снимается только один профиль
+profile_lock = asyncio.Lock()
+
+def sample_stacks(thread_id: int, seconds: float, interval: float = 0.005) -> Counter:
+    counts = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            counts[";".join(stack_of(frame))] += 1
+        time.sleep(interval)
+    return counts
+
+# ------------- ТЁПЛЫЙ СТАРТ -------------
+# То, что дорого получать заново (пользователи из Telegram, file_id загруженных
+# медиа), сохраняется в снимок при штатной остановке и лениво читается после
+# рестарта. Роли берутся из role_index, размуты — из outbox, их в снимке нет.
+SNAPSHOT_PATH = os.path.join(RESOURCES_DIR, "warm_state.json.gz")
+SNAPSHOT_VERSION = 2
+
+# username в кэш не попадает: он может перейти к другому аккаунту, поэтому
+# упоминания строятся по id (tg://user?id=...)
+CachedUser = namedtuple("CachedUser", "id first_name")
+
+class WarmState:
+    def __init__(self, path, user_ttl):
+        self.path = path
+        self.user_ttl = user_ttl
+        self.loaded = False
+        # структура: { user_id : (CachedUser, время получения) }
+        self.users = {}
+        # структура: { имя файла : (mtime файла, file_id) }
+        self.media = {}
+
+    def ensure_loaded(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                logging.warning(f"Не удалось прочитать снимок состояния: {e}")
+            return
+        if snapshot.get("version") != SNAPSHOT_VERSION:
+            return
+        now = time.time()
+        for user_id, first_name, resolved_at in snapshot.get("users", []):
+            if now - resolved_at < self.user_ttl:
+                self.remember_user(CachedUser(user_id, first_name), resolved_at)
+        for name, mtime, file_id in snapshot.get("media", []):
+            self.media[name] = (mtime, file_id)
+        logging.info(f"Снимок состояния загружен: {len(self.users)} пользователей, {len(self.media)} медиа")
+
+    def remember_user(self, user, resolved_at=None) -> CachedUser:
+        cached = CachedUser(user.id, user.first_name)
+        self.users[cached.id] = (cached, resolved_at or time.time())
+        return cached
+
+    def get_user(self, user_id: int):
+        self.ensure_loaded()
+        entry = self.users.get(user_id)
+        if entry is None or time.time() - entry[1] >= self.user_ttl:
+            return None
+        return entry[0]
+
+    def get_media(self, path: str):
+        self.ensure_loaded()
+        entry = self.media.get(os.path.basename(path))
+        # файл заменили — старый file_id уже не про него
+        if entry is None or entry[0] != os.path.getmtime(path):
+            return None
+        return entry[1]
+
+    def remember_media(self, path: str, file_id: str):
+        self.media[os.path.basename(path)] = (os.path.getmtime(path), file_id)
+
+    def save(self):
+        self.ensure_loaded()
+        snapshot = {
+            "version": SNAPSHOT_VERSION,
+            "users": [[u.id, u.first_name, ts] for u, ts in self.users.values()],
+            "media": [[name, mtime, file_id] for name, (mtime, file_id) in self.media.items()],
+        }
+        tmp_path = self.path + ".tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump(snapshot, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, self.path)
+
+warm_state = WarmState(SNAPSHOT_PATH, USER_CACHE_TTL)
+
+async def resolve_user(client: Client, query):
+    # Из кэша отвечаем только по id. @username всегда спрашиваем у Telegram:
+    # username может перейти к другому аккаунту, а по нему кикают и банят
+    if isinstance(query, int):
+        cached = warm_state.get_user(query)
+        if cached:
+            return cached
+    return warm_state.remember_user(await client.get_users(query))
+
+async def resolve_users(client: Client, user_ids: list) -> list:
+    users = {}
+    missing = []
+    for uid in user_ids:
+        cached = warm_state.get_user(uid)
+        if cached:
+            users[uid] = cached
+        else:
+            missing.append(uid)
+    if missing:
+        # недостающих запрашиваем одним вызовом
+        for user in await client.get_users(missing):
+            users[user.id] = warm_state.remember_user(user)
+    return [users[uid] for uid in user_ids if uid in users]
+
 # ------------- ИНИЦИАЛИЗАЦИЯ КЛИЕНТА -------------
 session_path = os.path.join(RESOURCES_DIR, "admin_bot")
-app = Client(session_path, api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
+app = Client(session_path, api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN, workers=WORKERS)
 
 # ------------- ДИНАМИЧЕСКИЙ /help -------------
 @app.on_message(filters.command("help") & filters.group)
@@ -241,17 +1198,24 @@ async def help_handler(client, message):
             "/clear — блокировка пользователя и удаление его сообщений (требуется подтверждение другого админа при уровне < 2)\n\n"
             "/шлюхобот — блокировка и отправка публичного сообщения (требуется подтверждение другого админа при уровне < 2)\n\n"
         )
-    elif role == 2:
+    if role >= 2:
+        text += "/stats [дни] — статистика модерации чата (по умолчанию за 7 дней)\n\n"
+    if role == 2:
         text += "/promote @username 1 — назначить Модератора\n\n"
         text += "/demote @username — снять роль Модератора\n\n"
     elif role == 3:
         text += (
+            "/federation on|off — подключить чат к общему бан-листу сети\n\n"
+            "/unfedban @username — убрать пользователя из общего бан-листа\n\n"
             "/promote @username [1-3] — назначить Модератора, Админа или Владельца\n\n"
             "/demote @username — снять роль Модератора, Админа или Владельца\n\n"
         )
     elif role == 4:
         text += (
+            "/federation on|off — подключить чат к общему бан-листу сети\n\n"
+            "/unfedban @username — убрать пользователя из общего бан-листа\n\n"
             "/promote @username [1-4] — назначить любую роль\n\n"
+            "/profile [секунды] — снять профиль работы бота (присылается в ЛС)\n\n"
             "/demote @username — снять любую роль\n\n"
         )
     await message.reply(text)
@@ -260,6 +1224,15 @@ async def help_handler(client, message):
 @app.on_message(filters.new_chat_members)
 async def greet_new_users(client, message):
     for new_user in message.new_chat_members:
+        # 0) Пользователь из общего бан-листа федерации — сразу баним
+        if (is_federated(message.chat.id) and is_federally_banned(new_user.id)
+                and get_role(message.chat.id, new_user.id) < 1):
+            queue_fanout_ban(message.chat.id, new_user.id,
+                             f"fedban:join:{message.chat.id}:{new_user.id}:{message.id}", replace=True)
+            conn.commit()
+            outbox.notify()
+            continue
+
         # 1) Отправляем видео-приветствие если есть FILE_ID
         if FILE_ID:
             try:
@@ -309,6 +1282,7 @@ def parse_duration(text: str) -> int:
 
 # ------------- ХАНДЛЕР ДЛЯ /report -------------
 @app.on_message(filters.command("report") & filters.group)
+@serialized_per_chat
 async def report_handler(client, message):
     chat_id = message.chat.id
     sender = message.from_user
@@ -334,7 +1308,7 @@ async def report_handler(client, message):
     else:
         if len(args) >= 2 and args[1].startswith("@"):
             try:
-                reported_user = await client.get_users(args[1])
+                reported_user = await resolve_user(client, args[1])
             except RPCError:
                 await message.reply("Не могу найти пользователя.")
                 return
@@ -342,27 +1316,55 @@ async def report_handler(client, message):
         else:
             await message.reply("Используй: /report в ответ на сообщение или /report @username [сообщение]")
             return
+    # Повторный репорт на то же сообщение (или пользователя) — обновляем старый
+    now = time.time()
+    target = ("message", reported_message.id) if message.reply_to_message else ("user", reported_user.id)
+    report = report_aggregator.get_report(chat_id, target, now)
+    if report:
+        report["count"] += 1
+        try:
+            await client.edit_message_text(chat_id, report["message_id"], format_report(report))
+            return
+        except RPCError as e:
+            # сообщение удалили или его нельзя изменить — шлём новый репорт
+            logging.warning(f"Не удалось обновить репорт: {e}")
+
     chat_admins = conn.execute("SELECT user_id, role FROM admins WHERE chat_id = ?", (chat_id,)).fetchall()
-    mentions = []
-    for uid, role_int in chat_admins:
-        if role_int >= 1:
-            try:
-                user = await client.get_users(uid)
-                mentions.append(f"@{user.username}" if user.username else f"[{user.first_name}](tg://user?id={user.id})")
-            except RPCError:
-                pass
-    if not mentions:
+    moderator_ids = [uid for uid, role_int in chat_admins if role_int >= 1]
+    if not moderator_ids:
         await message.reply("Нет активных модераторов/админов/владельцев.")
         return
-    ping_list = " ".join(mentions)
+    ping_ids = report_aggregator.pingable(chat_id, moderator_ids, now)
+    users = []
+    if ping_ids:
+        try:
+            users = await resolve_users(client, ping_ids)
+        except RPCError as e:
+            logging.warning(f"Не удалось получить модераторов для репорта: {e}")
+    mentions = [f"[{user.first_name}](tg://user?id={user.id})" for user in users]
+    if mentions:
+        ping_line = f"Внимание: {' '.join(mentions)}"
+    elif ping_ids:
+        # никого не упомянули — в следующий раз попробуем снова
+        ping_line = "Не удалось упомянуть модераторов."
+    else:
+        ping_line = "Модераторы уже оповещены."
     reporter_link = f"[{sender.first_name}](tg://user?id={sender.id})"
     reported_link = f"[{reported_user.first_name}](tg://user?id={reported_user.id})"
-    header = f"{reporter_link} зарепортил(а) {reported_link}"
-    reply_msg = f"{header}\n> {content}\nВнимание: {ping_list}"
-    await message.reply(reply_msg)
+    new_report = {
+        "count": report["count"] if report else 1,
+        "header": f"{reporter_link} зарепортил(а) {reported_link}",
+        "content": content,
+        "ping_line": ping_line,
+    }
+    reply = await message.reply(format_report(new_report))
+    report_aggregator.mark_pinged(chat_id, [user.id for user in users], now)
+    new_report["message_id"] = reply.id
+    report_aggregator.add_report(chat_id, target, new_report, now)
 
 # ------------- ХАНДЛЕР ДЛЯ /promote -------------
 @app.on_message(filters.command("promote") & filters.group)
+@serialized_per_chat
 async def promote_handler(client, message):
     chat_id = message.chat.id
     sender = message.from_user
@@ -373,7 +1375,7 @@ async def promote_handler(client, message):
         return
 
     try:
-        target_user = await client.get_users(args[1])
+        target_user = await resolve_user(client, args[1])
     except RPCError:
         await message.reply("Не могу найти пользователя.")
         return
@@ -412,7 +1414,7 @@ async def promote_handler(client, message):
 
     set_role(chat_id, target_user.id, new_role)
     await message.reply(f"{args[1]} теперь {role_to_str(new_role)}.")
-    log_action(target_user.id, f"повышение до {new_role}", sender.id, chat_id)
+    log_action(target_user.id, ACTION_PROMOTE, sender.id, chat_id, new_role=new_role)
 
     try:
         chat_link = f"[{message.chat.title}](tg://chat?id={chat_id})"
@@ -422,6 +1424,7 @@ async def promote_handler(client, message):
 
 # ------------- ХАНДЛЕР ДЛЯ /demote -------------
 @app.on_message(filters.command("demote") & filters.group)
+@serialized_per_chat
 async def demote_handler(client, message):
     chat_id = message.chat.id
     sender = message.from_user
@@ -430,7 +1433,7 @@ async def demote_handler(client, message):
         await message.reply("Используй: /demote @username")
         return
     try:
-        target_user = await client.get_users(args[1])
+        target_user = await resolve_user(client, args[1])
     except RPCError:
         await message.reply("Не могу найти пользователя.")
         return
@@ -459,7 +1462,7 @@ async def demote_handler(client, message):
         return
     del_role(chat_id, target_user.id)
     await message.reply(f"{args[1]} понижен(а).)")
-    log_action(target_user.id, "понижение", sender.id, chat_id)
+    log_action(target_user.id, ACTION_DEMOTE, sender.id, chat_id)
     try:
         chat_link = f"[{message.chat.title}](tg://chat?id={chat_id})"
         await client.send_message(target_user.id, f"Тебя понизили в {chat_link}.", parse_mode=ParseMode.MARKDOWN)
@@ -468,6 +1471,7 @@ async def demote_handler(client, message):
 
 # ------------- ХАНДЛЕР ДЛЯ /kick -------------
 @app.on_message(filters.command("kick") & filters.group)
+@serialized_per_chat
 async def kick_handler(client, message):
     chat_id = message.chat.id
     sender = message.from_user
@@ -479,7 +1483,7 @@ async def kick_handler(client, message):
         target_user = message.reply_to_message.from_user
     elif len(args) >= 2 and args[1].startswith("@"):
         try:
-            target_user = await client.get_users(args[1])
+            target_user = await resolve_user(client, args[1])
         except RPCError:
             await message.reply("Не могу найти пользователя.")
             return
@@ -508,19 +1512,21 @@ async def kick_handler(client, message):
     reason = args[2] if len(args) == 3 else None
     try:
         await client.ban_chat_member(chat_id, target_user.id)
-        await client.unban_chat_member(chat_id, target_user.id)
     except RPCError as e:
         await message.reply(f"Не смог кикнуть: {e}")
         return
+    # разбан уходит в outbox и коммитится вместе с записью в логах
+    enqueue_job("unban", chat_id, target_user.id, time.time(), f"unban:{chat_id}:{target_user.id}:{message.id}")
 
     if reason:
         reply_text = f"{target_user.first_name} кикнут(а) по причине \"{reason}\""
         user_text = f"Ты кикнут(а) из [чат](tg://chat?id={chat_id}) по причине \"{reason}\""
-        log_action(target_user.id, f"кик по причине {reason}", sender.id, chat_id)
+        log_action(target_user.id, ACTION_KICK, sender.id, chat_id, reason=reason)
     else:
         reply_text = f"{target_user.first_name} кикнут(а)"
         user_text = f"Ты кикнут(а) из [чат](tg://chat?id={chat_id})"
-        log_action(target_user.id, "кик без причины", sender.id, chat_id)
+        log_action(target_user.id, ACTION_KICK, sender.id, chat_id)
+    outbox.notify()
 
     await message.reply(reply_text)
     try:
@@ -530,6 +1536,7 @@ async def kick_handler(client, message):
 
 # ------------- ХАНДЛЕР ДЛЯ /mute -------------
 @app.on_message(filters.command("mute") & filters.group)
+@serialized_per_chat
 async def mute_handler(client, message):
     chat_id = message.chat.id
     sender = message.from_user
@@ -545,7 +1552,7 @@ async def mute_handler(client, message):
             time_arg = None
     elif len(args) >= 2 and args[1].startswith("@"):
         try:
-            target_user = await client.get_users(args[1])
+            target_user = await resolve_user(client, args[1])
         except RPCError:
             await message.reply("Не могу найти пользователя.")
             return
@@ -593,15 +1600,15 @@ async def mute_handler(client, message):
     chat_link = f"[{message.chat.title}](tg://chat?id={chat_id})"
     until_str = until_date_dt.strftime("%Y-%m-%d %H:%M UTC")
     await message.reply(f"{target_user.first_name} замучен(а) до {until_str}.")
-    log_action(target_user.id, f"замьютил до {until_str}", sender.id, chat_id)
+    log_action(target_user.id, ACTION_MUTE, sender.id, chat_id, duration=mute_seconds)
     try:
         await client.send_message(target_user.id, f"Ты замучен(а) до {until_str} в {chat_link}.", parse_mode=ParseMode.MARKDOWN)
     except RPCError:
         pass
-    asyncio.create_task(schedule_unmute(client, chat_id, target_user.id, unmute_ts))
 
 # ------------- ХАНДЛЕР ДЛЯ /unmute -------------
 @app.on_message(filters.command("unmute") & filters.group)
+@serialized_per_chat
 async def unmute_handler(client, message):
     chat_id = message.chat.id
     sender = message.from_user
@@ -612,7 +1619,7 @@ async def unmute_handler(client, message):
         target_user = message.reply_to_message.from_user
     elif len(args) >= 2 and args[1].startswith("@"):
         try:
-            target_user = await client.get_users(args[1])
+            target_user = await resolve_user(client, args[1])
         except RPCError:
             await message.reply("Не могу найти пользователя.")
             return
@@ -653,7 +1660,7 @@ async def unmute_handler(client, message):
 
     del_mute(chat_id, target_user.id)
     await message.reply(f"{target_user.first_name} размучен(а).")
-    log_action(target_user.id, "размутил", sender.id, chat_id)
+    log_action(target_user.id, ACTION_UNMUTE, sender.id, chat_id)
     try:
         chat_link = f"[{message.chat.title}](tg://chat?id={chat_id})"
         await client.send_message(target_user.id, f"Ты размучен(а) в {chat_link}.", parse_mode=ParseMode.MARKDOWN)
@@ -673,7 +1680,7 @@ async def logs_handler(client, message):
         await message.reply("Используй: /logs @username")
         return
     try:
-        target_user = await client.get_users(args[1])
+        target_user = await resolve_user(client, args[1])
     except RPCError:
         await message.reply("Не могу найти пользователя.")
         return
@@ -682,17 +1689,142 @@ async def logs_handler(client, message):
         await message.reply("У этого пользователя нет записей в логах.")
         return
     text = f"Логи для {args[1]}:\n"
-    for time_ts, action in user_logs:
+    for time_ts, action, duration, reason, new_role in user_logs:
         t = datetime.fromtimestamp(time_ts, timezone.utc).strftime("%Y-%m-%d %H:%M UTC")
-        text += f"{t} — {action}\n"
+        text += f"{t} — {render_action(time_ts, action, duration, reason, new_role)}\n"
     try:
         await client.send_message(sender.id, text)
         await message.reply("Отправил логи в ЛС.")
     except RPCError:
         await message.reply("Не могу отправить ЛС. Напиши боту первым.")
 
+# ------------- ХАНДЛЕР ДЛЯ /stats -------------
+def format_stats(totals) -> str:
+    if not totals:
+        return "нет действий"
+    return ", ".join(f"{label}: {count}" for label, count in totals.items())
+
+@app.on_message(filters.command("stats") & filters.group)
+async def stats_handler(client, message):
+    chat_id = message.chat.id
+    sender = message.from_user
+    if get_role(chat_id, sender.id) < 2:
+        await message.reply("Нельзя: недостаточно прав.")
+        return
+    args = message.text.split()
+    days = 7
+    if len(args) >= 2:
+        if not args[1].isdigit() or int(args[1]) < 1:
+            await message.reply("Используй: /stats [дни]")
+            return
+        days = int(args[1])
+    since_day = int(time.time()) // 86400 - days + 1
+
+    text = f"Статистика за {days} дн.:\n{format_stats(get_chat_stats(chat_id, since_day))}\n"
+    moderators = get_moderator_stats(chat_id, since_day)
+    if moderators:
+        text += "\nПо модераторам:\n"
+        for by_id, totals in moderators.items():
+            if totals:
+                text += f"[ID:{by_id}](tg://user?id={by_id}) — {format_stats(totals)}\n"
+    most_sanctioned = get_most_sanctioned(chat_id)
+    if most_sanctioned:
+        text += "\nЧаще всех наказаны (за всё время):\n"
+        for target_id, total in most_sanctioned:
+            text += f"[ID:{target_id}](tg://user?id={target_id}) — {total}\n"
+    await message.reply(text)
+
+# ------------- ХАНДЛЕР ДЛЯ /federation -------------
+@app.on_message(filters.command("federation") & filters.group)
+@serialized_per_chat
+async def federation_handler(client, message):
+    chat_id = message.chat.id
+    sender = message.from_user
+    args = message.text.split()
+    if len(args) < 2:
+        status = "в федерации" if is_federated(chat_id) else "не в федерации"
+        await message.reply(f"Чат {status}. Используй: /federation on|off")
+        return
+    if get_role(chat_id, sender.id) < 3:
+        await message.reply("Нельзя: недостаточно прав.")
+        return
+    if args[1] == "on":
+        set_federated(chat_id, True)
+        await message.reply("Чат подключён к федерации: баны через /clear и /шлюхобот будут применяться во всех чатах сети.")
+    elif args[1] == "off":
+        set_federated(chat_id, False)
+        await message.reply("Чат отключён от федерации.")
+    else:
+        await message.reply("Используй: /federation on|off")
+
+# ------------- ХАНДЛЕР ДЛЯ /unfedban -------------
+@app.on_message(filters.command("unfedban") & filters.group)
+@serialized_per_chat
+async def unfedban_handler(client, message):
+    chat_id = message.chat.id
+    sender = message.from_user
+    if get_role(chat_id, sender.id) < 3:
+        await message.reply("Нельзя: недостаточно прав.")
+        return
+    if not is_federated(chat_id):
+        await message.reply("Чат не в федерации.")
+        return
+    args = message.text.split()
+    if message.reply_to_message:
+        target_user = message.reply_to_message.from_user
+    elif len(args) >= 2 and args[1].startswith("@"):
+        try:
+            target_user = await resolve_user(client, args[1])
+        except RPCError:
+            await message.reply("Не могу найти пользователя.")
+            return
+    else:
+        await message.reply("Используй: /unfedban @username или в ответ на сообщение")
+        return
+    if not is_federally_banned(target_user.id):
+        await message.reply("Пользователя нет в общем бан-листе.")
+        return
+    lift_federated_ban(target_user.id, sender.id, chat_id)
+    await message.reply(f"{target_user.first_name} убран(а) из общего бан-листа и будет разбанен(а) в чатах федерации.")
+
+# ------------- ХАНДЛЕР ДЛЯ /profile -------------
+@app.on_message(filters.command("profile") & filters.group)
+async def profile_handler(client, message):
+    chat_id = message.chat.id
+    sender = message.from_user
+    # профиль показывает весь процесс бота, а не один чат
+    if get_role(chat_id, sender.id) < 4 and sender.id != OPERATOR_ID:
+        await message.reply("Нельзя: недостаточно прав.")
+        return
+    args = message.text.split()
+    seconds = 10
+    if len(args) >= 2:
+        if not args[1].isdigit() or not 1 <= int(args[1]) <= PROFILE_MAX_SECONDS:
+            await message.reply(f"Используй: /profile [секунды, 1-{PROFILE_MAX_SECONDS}]")
+            return
+        seconds = int(args[1])
+    if profile_lock.locked():
+        await message.reply("Профиль уже снимается, подожди.")
+        return
+    async with profile_lock:
+        await message.reply(
+            f"Задержка цикла: сейчас {loop_monitor.last_lag * 1000:.0f} мс, "
+            f"максимум {loop_monitor.max_lag * 1000:.0f} мс. Снимаю профиль {seconds} с..."
+        )
+        # сэмплер работает в отдельном потоке, цикл событий продолжает обслуживать хендлеры
+        counts = await asyncio.to_thread(sample_stacks, threading.get_ident(), seconds)
+    collapsed = "\n".join(f"{stack} {count}" for stack, count in counts.most_common())
+    document = io.BytesIO(collapsed.encode("utf-8"))
+    document.name = f"profile-{int(time.time())}.collapsed"
+    try:
+        await client.send_document(sender.id, document, caption=f"Профиль за {seconds} с (collapsed stacks)")
+        await message.reply("Отправил профиль в ЛС.")
+    except RPCError:
+        await message.reply("Не могу отправить ЛС. Напиши боту первым.")
+
 # ------------- ХАНДЛЕР ДЛЯ /clear -------------
 @app.on_message(filters.command("clear") & filters.group)
+@serialized_per_chat
 async def clear_handler(client, message):
     chat_id = message.chat.id
     sender = message.from_user
@@ -706,7 +1838,7 @@ async def clear_handler(client, message):
         target_user = message.reply_to_message.from_user
     elif len(message.text.split()) >= 2 and message.text.split()[1].startswith("@"):
         try:
-            target_user = await client.get_users(message.text.split()[1])
+            target_user = await resolve_user(client, message.text.split()[1])
         except RPCError:
             await message.reply("Не могу найти пользователя.")
             return
@@ -731,7 +1863,8 @@ async def clear_handler(client, message):
             await client.ban_chat_member(chat_id, target_user.id)
 
         await message.reply(f"Пользователь {target_user.first_name} заблокирован и все его сообщения удалены.")
-        log_action(target_user.id, "clear (бан + удаление сообщений)", sender.id, chat_id)
+        log_action(target_user.id, ACTION_CLEAR, sender.id, chat_id)
+        start_federated_ban(chat_id, target_user.id, sender.id)
 
     except RPCError as e:
         await message.reply(f"Не удалось выполнить операцию: {e}")
@@ -739,6 +1872,7 @@ async def clear_handler(client, message):
 
 # ------------- ХАНДЛЕР ДЛЯ /delete -------------
 @app.on_message(filters.command("delete") & filters.group & filters.reply)
+@serialized_per_chat
 async def delete_handler(client, message):
     chat_id = message.chat.id
     sender = message.from_user
@@ -751,7 +1885,7 @@ async def delete_handler(client, message):
         try:
             await message.reply_to_message.delete()
             await message.reply("Сообщение удалено.")
-            log_action(message.reply_to_message.from_user.id, "delete (удаление сообщения)", sender.id, chat_id)
+            log_action(message.reply_to_message.from_user.id, ACTION_DELETE, sender.id, chat_id)
         except RPCError as e:
             await message.reply(f"Не удалось удалить сообщение: {e}")
     else:
@@ -765,7 +1899,7 @@ async def delete_handler(client, message):
                 await target_message.delete()
                 await message.reply("Сообщение удалено.")
                 del client.pending_deletes[target_message_id]
-                log_action(target_message.from_user.id, "delete (удаление сообщения)", sender.id, chat_id)
+                log_action(target_message.from_user.id, ACTION_DELETE, sender.id, chat_id)
             except RPCError as e:
                 await message.reply(f"Не удалось удалить сообщение: {e}")
         else:
@@ -774,6 +1908,7 @@ async def delete_handler(client, message):
 
 # ------------- ХАНДЛЕР ДЛЯ /шлюхобот -------------
 @app.on_message(filters.command("шлюхобот") & filters.group & filters.reply)
+@serialized_per_chat
 async def whorebot_handler(client, message):
     chat_id = message.chat.id
     sender = message.from_user
@@ -815,16 +1950,28 @@ async def whorebot_handler(client, message):
         except TypeError:
             # Если версия pyrogram не поддерживает revoke_messages
             await client.ban_chat_member(chat_id, target_user.id)
+        start_federated_ban(chat_id, target_user.id, sender.id)
 
         # Отправляем отчёт: картинка resources/whore.jpg + текст из config["whore"]
         whore_message = config.get("whore", "Сообщение не найдено в конфигурации.")
         whore_path = os.path.join(RESOURCES_DIR, "whore.jpg")
         try:
             if os.path.exists(whore_path):
-                await client.send_photo(chat_id, whore_path, caption=whore_message)
+                # после первой загрузки картинка отправляется по file_id
+                file_id = warm_state.get_media(whore_path)
+                try:
+                    sent = await client.send_photo(chat_id, file_id or whore_path, caption=whore_message)
+                except BadRequest:
+                    if not file_id:
+                        raise
+                    # сохранённый file_id больше не принимается — загружаем файл заново
+                    file_id = None
+                    sent = await client.send_photo(chat_id, whore_path, caption=whore_message)
+                if not file_id and sent.photo:
+                    warm_state.remember_media(whore_path, sent.photo.file_id)
             else:
                 await client.send_message(chat_id, whore_message)
-            log_action(target_user.id, "шлюхобот (бан и отправка отчёта)", sender.id, chat_id)
+            log_action(target_user.id, ACTION_WHOREBOT, sender.id, chat_id)
         except RPCError as e:
             logging.warning(f"Не удалось отправить whore-отчёт: {e}")
             # Попытка упрощённого ответа, чтобы хоть что-то было видно
@@ -837,18 +1984,30 @@ async def whorebot_handler(client, message):
         await message.reply(f"Не удалось выполнить операцию: {e}")
 
 # ------------- СТАРТ БОТА -------------
+async def main():
+    await app.start()
+    # Размуты и прочие отложенные действия продолжаются из outbox
+    asyncio.create_task(outbox.dispatch(app))
+    if LOG_CHAT_ID:
+        asyncio.create_task(event_feed(app))
+    # Продолжаем прерванные рассылки федеративных банов
+    for job_id in get_pending_fanout_jobs():
+        asyncio.create_task(run_fanout(job_id))
+    asyncio.create_task(backfill_legacy_logs())
+    asyncio.create_task(loop_monitor.probe())
+    asyncio.create_task(cleanup_logs())
+    # Ждём остановки
+    await idle()
+    # даём доработать уже принятым командам
+    await chat_actors.drain()
+    try:
+        warm_state.save()
+    except OSError as e:
+        logging.warning(f"Не удалось сохранить снимок состояния: {e}")
+    await app.stop()
+
 if __name__ == "__main__":
     try:
-        app.start()
-        now_ts = int(time.time())
-        # Восстанавливаем незавершённые мьюты
-        for chat_id, user_id, unmute_ts in get_all_mutes():
-            if unmute_ts <= now_ts:
-                asyncio.create_task(schedule_unmute(app, chat_id, user_id, now_ts))
-            else:
-                asyncio.create_task(schedule_unmute(app, chat_id, user_id, unmute_ts))
-        # Ждём остановки
-        idle()
-        app.stop()
+        app.run(main())
     except KeyboardInterrupt:
         logging.info("Остановка бота")
@@ -0,0 +1,133 @@
+import asyncio
+import importlib
+import json
+import random
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("pyrogram")
+pytest.importorskip("dotenv")
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+CHATS = [-1001, -1002, -1003]
+FOUNDER_ID = 1
+MUTE_TARGETS = [101, 102, 103]
+ROLE_TARGETS = [201, 202]
+
+
+@pytest.fixture(scope="module")
+def bot(tmp_path_factory):
+    # main.py всё делает при импорте: база, конфиг и сессия — относительно cwd
+    workdir = tmp_path_factory.mktemp("bot")
+    (workdir / "resources").mkdir()
+    (workdir / "resources" / "config.json").write_text(
+        json.dumps({"default_mute_seconds": 600, "log_chat_id": 0}), encoding="utf-8"
+    )
+    mp = pytest.MonkeyPatch()
+    mp.chdir(workdir)
+    mp.setenv("API_ID", "1")
+    mp.setenv("API_HASH", "hash")
+    mp.setenv("BOT_TOKEN", "1:token")
+    mp.syspath_prepend(str(REPO_ROOT))
+    sys.modules.pop("main", None)
+    module = importlib.import_module("main")
+    yield module
+    module.conn.close()
+    sys.modules.pop("main", None)
+    mp.undo()
+
+
+class FakeTelegram:
+    """Клиент с сетевой задержкой на каждом вызове: без очереди по чату
+    параллельные команды перемешиваются между RPC и записью в базу."""
+
+    def __init__(self):
+        self.users = {
+            uid: SimpleNamespace(id=uid, first_name=f"user{uid}", username=f"user{uid}")
+            for uid in [FOUNDER_ID, *MUTE_TARGETS, *ROLE_TARGETS]
+        }
+        # структура: { (chat_id, user_id) : замучен ли }
+        self.restricted = {}
+
+    async def latency(self):
+        await asyncio.sleep(random.uniform(0, 0.003))
+
+    async def get_users(self, query):
+        await self.latency()
+        if isinstance(query, str):
+            return self.users[int(query.removeprefix("@user"))]
+        return self.users[query]
+
+    async def restrict_chat_member(self, chat_id, user_id, permissions, until_date=None):
+        await self.latency()
+        self.restricted[(chat_id, user_id)] = not permissions.can_send_messages
+
+    async def send_message(self, *args, **kwargs):
+        await self.latency()
+
+
+def make_message(chat_id, text, message_id):
+    async def reply(_text):
+        await asyncio.sleep(random.uniform(0, 0.001))
+
+    return SimpleNamespace(
+        id=message_id,
+        chat=SimpleNamespace(id=chat_id, title=f"chat{chat_id}"),
+        from_user=SimpleNamespace(id=FOUNDER_ID, first_name="founder"),
+        text=text,
+        reply_to_message=None,
+        reply=reply,
+    )
+
+
+def test_interleaved_commands_leave_consistent_state(bot):
+    random.seed(29)
+    client = FakeTelegram()
+    for chat_id in CHATS:
+        bot.set_role(chat_id, FOUNDER_ID, 4)
+
+    # ожидаемое состояние — эффект последней команды в порядке поступления
+    expected_muted = {}
+    expected_roles = {}
+    commands = []
+    for i in range(1500):
+        chat_id = random.choice(CHATS)
+        if random.random() < 0.5:
+            uid = random.choice(MUTE_TARGETS)
+            command = random.choice(["mute", "unmute"])
+            text = f"/mute @user{uid} 1h" if command == "mute" else f"/unmute @user{uid}"
+            handler = bot.mute_handler if command == "mute" else bot.unmute_handler
+            expected_muted[(chat_id, uid)] = command == "mute"
+        else:
+            uid = random.choice(ROLE_TARGETS)
+            command = random.choice(["promote", "demote"])
+            text = f"/promote @user{uid} 1" if command == "promote" else f"/demote @user{uid}"
+            handler = bot.promote_handler if command == "promote" else bot.demote_handler
+            expected_roles[(chat_id, uid)] = 1 if command == "promote" else 0
+        commands.append(handler(client, make_message(chat_id, text, i)))
+
+    async def run():
+        # хендлеры только ставят команду в очередь чата и сразу возвращаются
+        await asyncio.gather(*commands)
+        await bot.chat_actors.drain()
+
+    asyncio.run(run())
+
+    db_mutes = {(c, u) for c, u, _ in bot.conn.execute("SELECT chat_id, user_id, unmute_ts FROM mutes")}
+    pending_unmutes = {
+        (c, u) for c, u in bot.conn.execute("SELECT chat_id, user_id FROM outbox WHERE kind = 'unmute'")
+    }
+    for key, muted in expected_muted.items():
+        assert client.restricted.get(key, False) == muted
+        assert (key in db_mutes) == muted
+        assert (key in pending_unmutes) == muted
+
+    db_roles = {(c, u): r for c, u, r in bot.conn.execute("SELECT chat_id, user_id, role FROM admins")}
+    for (chat_id, uid), role in expected_roles.items():
+        assert bot.get_role(chat_id, uid) == role
+        assert db_roles.get((chat_id, uid), 0) == role
+
+    assert not bot.chat_actors.mailboxes